@@ -1,183 +1,310 @@
+import argparse
 import duckdb
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 import os
-from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
 
-def extract_chamber_active_periods(con, output_dir="chamber_data"):
+# Seconds of data kept before and after each active period
+BUFFER_SECONDS = 5
+
+# Rows fetched per Arrow record batch when streaming results to Parquet
+BATCH_ROWS = 100_000
+
+# Columns of JAAR_raw used by the extraction
+RAW_COLUMNS = [
+    'TIMESTAMP',
+    'ChamberID',
+    'ChamberStatus',
+    'ChamberTC',
+    'CH4',
+    'CO2',
+    'N2O',
+    'H2O_LI7810',
+    'H2O_LI7820',
+    'PPFD',
+    'PS01'
+]
+
+# Rows of each session's buffered window. Each session is listed once for
+# every time bucket its buffer touches, so the raw rows join on ChamberID
+# and their own bucket by equality and the window check only runs against
+# the few sessions sharing that bucket
+SESSION_DATA_VIEW = """
+CREATE OR REPLACE TEMP VIEW session_data AS
+WITH session_bounds AS (
+    SELECT * REPLACE (
+        CAST(buffer_start AS TIMESTAMP) AS buffer_start,
+        CAST(buffer_end AS TIMESTAMP) AS buffer_end
+    )
+    FROM sessions
+),
+session_buckets AS (
+    SELECT 
+        *,
+        UNNEST(generate_series(
+            CAST(floor(epoch(buffer_start) / {bucket_seconds}) AS BIGINT),
+            CAST(floor(epoch(buffer_end) / {bucket_seconds}) AS BIGINT)
+        )) AS bucket
+    FROM session_bounds
+)
+SELECT 
+    """ + ",\n    ".join("r." + column for column in RAW_COLUMNS) + """,
+    s.session_number,
+    s.active_start,
+    s.active_end,
+    s.duration_seconds,
+    r.ChamberStatus != 0.0 AS is_active
+FROM JAAR_raw r
+JOIN session_buckets s
+    ON r.ChamberID = s.ChamberID
+    AND CAST(floor(epoch(CAST(r.TIMESTAMP AS TIMESTAMP)) / {bucket_seconds}) AS BIGINT) = s.bucket
+    AND CAST(r.TIMESTAMP AS TIMESTAMP) BETWEEN s.buffer_start AND s.buffer_end
+"""
+
+def _check_raw_table(con):
+    """
+    Check that JAAR_raw exists and has the columns used here. This reads
+    the catalog only, so the table itself is not scanned.
+    """
+    columns = {name.lower() for (name,) in con.execute("""
+        SELECT column_name
+        FROM duckdb_columns()
+        WHERE database_name = current_database()
+            AND schema_name = current_schema()
+            AND lower(table_name) = 'jaar_raw'
+    """).fetchall()}
+    if not columns:
+        raise ValueError("Table JAAR_raw not found in the database")
+    missing = [column for column in RAW_COLUMNS if column.lower() not in columns]
+    if missing:
+        raise ValueError(f"JAAR_raw is missing columns: {', '.join(missing)}")
+
+def _create_session_view(cur, sessions_df):
+    """
+    Register the sessions table and the session_data view on a connection
+    or cursor. Both are local to the cursor they are created on.
+    """
+    cur.register("sessions", sessions_df)
+    # Buckets as long as the average buffered session keep both the number
+    # of buckets per session and the number of sessions per bucket small
+    buffered_seconds = (sessions_df['buffer_end'] - sessions_df['buffer_start']).dt.total_seconds()
+    bucket_seconds = max(buffered_seconds.mean(), 1.0) if len(sessions_df) else 1.0
+    cur.execute(SESSION_DATA_VIEW.format(bucket_seconds=bucket_seconds))
+
+def _write_session_row_groups(writer, reader):
+    """
+    Write record batches ordered by session_number as row groups that never
+    mix sessions, returning the number of records written. At most
+    BATCH_ROWS rows of a session are buffered before they are written, so
+    longer sessions span several row groups and memory stays within about
+    two batches.
+    """
+    record_count = 0
+    pending = []
+    pending_rows = 0
+    pending_session = None
+    for batch in reader:
+        session_numbers = batch.column('session_number').to_numpy()
+        bounds = np.flatnonzero(np.diff(session_numbers)) + 1
+        for start, stop in zip([0, *bounds], [*bounds, batch.num_rows]):
+            if pending and (session_numbers[start] != pending_session or pending_rows >= BATCH_ROWS):
+                writer.write_table(pa.Table.from_batches(pending))
+                pending = []
+                pending_rows = 0
+            pending.append(batch.slice(start, stop - start))
+            pending_rows += stop - start
+            pending_session = session_numbers[start]
+        record_count += batch.num_rows
+    if pending:
+        writer.write_table(pa.Table.from_batches(pending))
+    return record_count
+
+def _export_chambers(cur, chamber_ids, output_dir):
+    """
+    Write the Parquet file for each of the given chambers using one
+    cursor, returning the number of records written per chamber.
+    """
+    record_counts = []
+    for chamber_id in chamber_ids:
+        chamber_number = int(chamber_id)
+        combined_parquet = os.path.join(output_dir, f"Chamber_{chamber_number}_all_sessions.parquet")
+        
+        # Stream the chamber's rows so at most a batch or two is in memory
+        reader = cur.execute("""
+        SELECT * FROM session_data
+        WHERE ChamberID = ?
+        ORDER BY session_number, TIMESTAMP
+        """, [chamber_id]).fetch_record_batch(BATCH_ROWS)
+        schema = reader.schema.with_metadata({
+            'chamber_id': str(chamber_number),
+            'buffer_seconds': str(BUFFER_SECONDS)
+        })
+        
+        with pq.ParquetWriter(combined_parquet, schema, compression='zstd') as writer:
+            record_count = _write_session_row_groups(writer, reader)
+        record_counts.append((chamber_id, record_count))
+    return record_counts
+
+def extract_chamber_active_periods(con, output_dir="chamber_data", max_workers=None, verbose=False):
     """
     Extract chamber data during active periods (ChamberStatus != 0.0) 
     plus 5 seconds before and after each active period.
-    Save each chamber's data to CSV and Excel files.
+    Save each chamber's data to one Parquet file whose row groups never
+    mix sessions, and the chamber id and buffer length in the Parquet
+    key-value metadata.
+    Returns the session summary as a DataFrame. The per-chamber files are
+    written by up to max_workers threads (default: CPU count).
+    Per-session details are only printed when verbose is True.
     """
     
-    # Create output directory if it doesn't exist
+    # Resolve the output directory once and create it if it doesn't exist
+    output_dir = os.path.abspath(os.fspath(output_dir))
     os.makedirs(output_dir, exist_ok=True)
     
-    # Step 1: Find all active periods for each chamber
-    print("Finding active periods for each chamber...")
+    _check_raw_table(con)
     
-    active_periods_query = """
-        WITH active_sessions AS (
-            SELECT 
-                ChamberID,
-                TIMESTAMP,
-                ChamberStatus,
-                LAG(ChamberStatus) OVER (PARTITION BY ChamberID ORDER BY TIMESTAMP) AS prev_status,
-                LEAD(ChamberStatus) OVER (PARTITION BY ChamberID ORDER BY TIMESTAMP) AS next_status
-            FROM JAAR_raw
-            ORDER BY ChamberID, TIMESTAMP
-        ),
-        session_starts AS (
-            SELECT 
-                ChamberID,
-                TIMESTAMP AS start_time
-            FROM active_sessions
-            WHERE ChamberStatus != 0.0 AND (prev_status = 0.0 OR prev_status IS NULL)
-        ),
-        session_ends AS (
+    cursors = []
+    try:
+        # Step 1: Find all active periods for each chamber
+        print("Finding active periods for each chamber...")
+        
+        active_periods_query = """
+            WITH active_sessions AS (
+                SELECT 
+                    ChamberID,
+                    TIMESTAMP,
+                    ChamberStatus,
+                    LAG(ChamberStatus) OVER (PARTITION BY ChamberID ORDER BY TIMESTAMP) AS prev_status,
+                    LEAD(ChamberStatus) OVER (PARTITION BY ChamberID ORDER BY TIMESTAMP) AS next_status
+                FROM JAAR_raw
+            ),
+            session_starts AS (
+                SELECT 
+                    ChamberID,
+                    TIMESTAMP AS start_time,
+                    ROW_NUMBER() OVER (PARTITION BY ChamberID ORDER BY TIMESTAMP) AS period_index
+                FROM active_sessions
+                WHERE ChamberStatus != 0.0 AND (prev_status = 0.0 OR prev_status IS NULL)
+            ),
+            session_ends AS (
+                SELECT 
+                    ChamberID,
+                    TIMESTAMP AS end_time,
+                    ROW_NUMBER() OVER (PARTITION BY ChamberID ORDER BY TIMESTAMP) AS period_index
+                FROM active_sessions
+                WHERE ChamberStatus != 0.0 AND (next_status = 0.0 OR next_status IS NULL)
+            )
             SELECT 
-                ChamberID,
-                TIMESTAMP AS end_time
-            FROM active_sessions
-            WHERE ChamberStatus != 0.0 AND (next_status = 0.0 OR next_status IS NULL)
-        )
-        SELECT 
-            s.ChamberID,
-            s.start_time,
-            e.end_time,
-            DATEDIFF('second', CAST(s.start_time AS TIMESTAMP), CAST(e.end_time AS TIMESTAMP)) AS duration_seconds
-        FROM session_starts s
-        JOIN session_ends e ON s.ChamberID = e.ChamberID
-        WHERE CAST(e.end_time AS TIMESTAMP) > CAST(s.start_time AS TIMESTAMP)
-        ORDER BY s.ChamberID, s.start_time
-        """
+                s.ChamberID,
+                ROW_NUMBER() OVER (ORDER BY s.ChamberID, s.start_time) AS session_number,
+                s.start_time AS active_start,
+                e.end_time AS active_end,
+                DATEDIFF('second', CAST(s.start_time AS TIMESTAMP), CAST(e.end_time AS TIMESTAMP)) AS duration_seconds
+            FROM session_starts s
+            -- Starts and ends alternate within a chamber, so the n-th start
+            -- belongs to the n-th end
+            JOIN session_ends e ON s.ChamberID = e.ChamberID AND s.period_index = e.period_index
+            WHERE CAST(e.end_time AS TIMESTAMP) > CAST(s.start_time AS TIMESTAMP)
+            ORDER BY session_number
+            """
 
-    
-    active_periods = con.execute(active_periods_query).fetchall()
-    
-    print(f"Found {len(active_periods)} active periods")
-    
-    # Step 2: Extract data for each active period with buffer
-    all_chamber_data = {}
-    session_count = 0
-    
-    for chamber_id, start_time, end_time, duration in active_periods:
-        session_count += 1
         
-        # Convert to datetime objects for calculation
-        start_dt = datetime.fromisoformat(str(start_time))
-        end_dt = datetime.fromisoformat(str(end_time))
+        sessions_df = con.execute(active_periods_query).df()
         
-        # Add 5 second buffer before and after
-        buffer_start = start_dt - timedelta(seconds=5)
-        buffer_end = end_dt + timedelta(seconds=5)
+        print(f"Found {len(sessions_df)} active periods")
         
-        print(f"Processing Chamber {chamber_id}, Session {session_count}")
-        print(f"  Active period: {start_time} to {end_time} ({duration:.0f} seconds)")
-        print(f"  With buffer: {buffer_start} to {buffer_end}")
+        # Step 2: Add a 5 second buffer before and after each session
+        buffer = pd.Timedelta(seconds=BUFFER_SECONDS)
+        sessions_df['buffer_start'] = pd.to_datetime(sessions_df['active_start']) - buffer
+        sessions_df['buffer_end'] = pd.to_datetime(sessions_df['active_end']) + buffer
         
-        # Query data for this period with buffer
-        data_query = f"""
+        # Report all sessions in one write rather than three prints per session
+        if verbose:
+            session_lines = []
+            for session in sessions_df.itertuples(index=False):
+                session_lines.append(f"Processing Chamber {session.ChamberID}, Session {session.session_number}")
+                session_lines.append(f"  Active period: {session.active_start} to {session.active_end} ({session.duration_seconds:.0f} seconds)")
+                session_lines.append(f"  With buffer: {session.buffer_start} to {session.buffer_end}")
+            if session_lines:
+                print("\n".join(session_lines))
+        
+        # Step 3: Define the data for all sessions as a single scan of JAAR_raw
+        _create_session_view(con, sessions_df)
+        
+        # Step 4: Create summary files
+        print("\nCreating summary files...")
+        
+        # Summarise every session in one aggregate over the session view
+        summary_df = con.execute("""
         SELECT 
-            TIMESTAMP, 
-            ChamberID, 
-            ChamberStatus, 
-            ChamberTC, 
-            CH4,
-            CO2,
-            N2O,
-            H2O_LI7810,
-            H2O_LI7820,
-            PPFD,
-            PS01
-        FROM JAAR_raw 
-        WHERE ChamberID = {chamber_id}
-        AND TIMESTAMP >= '{buffer_start}'
-        AND TIMESTAMP <= '{buffer_end}'
-        ORDER BY TIMESTAMP
-        """
+            'Chamber_' || CAST(TRUNC(ChamberID) AS BIGINT) || '_Session_' || session_number AS session_key,
+            ChamberID AS chamber_id,
+            session_number,
+            active_start,
+            active_end,
+            duration_seconds,
+            COUNT(*) AS total_records,
+            COUNT(*) FILTER (WHERE is_active) AS active_records,
+            AVG(CH4) AS avg_ch4,
+            AVG(CO2) AS avg_co2,
+            AVG(ChamberTC) AS avg_temp,
+            MIN(TIMESTAMP) AS min_timestamp,
+            MAX(TIMESTAMP) AS max_timestamp
+        FROM session_data
+        GROUP BY ChamberID, session_number, active_start, active_end, duration_seconds
+        ORDER BY session_number
+        """).df()
+        summary_df.to_csv(os.path.join(output_dir, "session_summary.csv"), index=False)
         
-        df = con.execute(data_query).df()
+        # Step 5: Write one data file per chamber, straight from the session
+        # view, with row groups split by session. Each worker owns its own
+        # cursor, as a connection is not safe to share between threads.
+        # Python scalars, as DuckDB cannot bind numpy integer ids as parameters
+        chambers = summary_df['chamber_id'].unique().tolist()
+        n_workers = max(1, min(max_workers or os.cpu_count() or 1, len(chambers)))
+        cursors = [con.cursor() for _ in range(n_workers)]
+        for cur in cursors:
+            _create_session_view(cur, sessions_df)
         
-        if len(df) > 0:
-            # Add metadata columns
-            df['session_number'] = session_count
-            df['active_start'] = start_time
-            df['active_end'] = end_time
-            df['duration_seconds'] = duration
-            df['is_active'] = df['ChamberStatus'] != 0.0
-            
-            # Store in dictionary
-            session_key = f"Chamber_{int(chamber_id)}_Session_{session_count}"
-            all_chamber_data[session_key] = df
-            
-            # Save individual session files
-            csv_filename = os.path.join(output_dir, f"{session_key}.csv")
-            excel_filename = os.path.join(output_dir, f"{session_key}.xlsx")
-            
-            df.to_csv(csv_filename, index=False)
-            df.to_excel(excel_filename, index=False)
-            
-            print(f"  Saved {len(df)} records to {csv_filename} and {excel_filename}")
-        else:
-            print(f"  No data found for this period")
+        with ThreadPoolExecutor(max_workers=n_workers) as pool:
+            results = pool.map(
+                lambda i: _export_chambers(cursors[i], chambers[i::n_workers], output_dir),
+                range(n_workers)
+            )
+            record_counts = dict(pair for worker_counts in results for pair in worker_counts)
+    finally:
+        # Release the worker cursors and the session table even when a step
+        # above fails
+        for cur in cursors:
+            cur.close()
+        con.execute("DROP VIEW IF EXISTS temp.session_data")
+        con.unregister("sessions")
     
-    # Step 3: Create summary files
-    print("\nCreating summary files...")
-    
-    # Summary of all sessions
-    summary_data = []
-    for session_key, df in all_chamber_data.items():
-        summary_data.append({
-            'session_key': session_key,
-            'chamber_id': df['ChamberID'].iloc[0],
-            'session_number': df['session_number'].iloc[0],
-            'active_start': df['active_start'].iloc[0],
-            'active_end': df['active_end'].iloc[0],
-            'duration_seconds': df['duration_seconds'].iloc[0],
-            'total_records': len(df),
-            'active_records': len(df[df['is_active']]),
-            'avg_ch4': df['CH4'].mean(),
-            'avg_co2': df['CO2'].mean(),
-            'avg_temp': df['ChamberTC'].mean(),
-            'min_timestamp': df['TIMESTAMP'].min(),
-            'max_timestamp': df['TIMESTAMP'].max()
-        })
-    
-    summary_df = pd.DataFrame(summary_data)
-    summary_df.to_csv(os.path.join(output_dir, "session_summary.csv"), index=False)
-    summary_df.to_excel(os.path.join(output_dir, "session_summary.xlsx"), index=False)
-    
-    # Combined data file for each chamber
-    chambers = summary_df['chamber_id'].unique()
     for chamber_id in chambers:
-        chamber_sessions = [data for key, data in all_chamber_data.items() 
-                          if data['ChamberID'].iloc[0] == chamber_id]
-        
-        if chamber_sessions:
-            combined_df = pd.concat(chamber_sessions, ignore_index=True)
-            combined_csv = os.path.join(output_dir, f"Chamber_{int(chamber_id)}_all_sessions.csv")
-            combined_excel = os.path.join(output_dir, f"Chamber_{int(chamber_id)}_all_sessions.xlsx")
-            
-            combined_df.to_csv(combined_csv, index=False)
-            combined_df.to_excel(combined_excel, index=False)
-            
-            print(f"Combined data for Chamber {chamber_id}: {len(combined_df)} records")
+        print(f"Saved data for Chamber {chamber_id}: {record_counts[chamber_id]} records")
     
     print(f"\nExtraction complete!")
-    print(f"Total sessions processed: {len(all_chamber_data)}")
+    print(f"Total sessions processed: {len(summary_df)}")
     print(f"Files saved to: {output_dir}/")
     print(f"Summary file: {output_dir}/session_summary.csv")
     
-    return all_chamber_data, summary_df
+    return summary_df
 
 # Usage
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Extract chamber active periods from JAAR_raw.")
+    parser.add_argument("--verbose", action="store_true",
+                        help="print details for every session")
+    args = parser.parse_args()
+    
     # Connect to your database
     con = duckdb.connect(database="dataset/ODB.duckdb")
     
     # Extract data
-    chamber_data, summary = extract_chamber_active_periods(con)
+    summary = extract_chamber_active_periods(con, verbose=args.verbose)
     
     # Display summary
     print("\n" + "="*50)